@@ -4,98 +4,83 @@
 Clean up duplicate beads epics by keeping only the newest one for each category.
 """
 import subprocess
-import json
-import re
 import sys
-from datetime import datetime
-from collections import defaultdict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Fix Windows console encoding
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
     sys.stderr.reconfigure(encoding='utf-8')
 
-def run_bd_command(args):
-    """Run a bd command and return output."""
-    result = subprocess.run(['bd'] + args, capture_output=True, text=True, encoding='utf-8', errors='ignore')
-    return result.stdout if result.stdout else ""
+def run_bd_json(args):
+    """Run a bd command with --json and return the parsed output."""
+    # Both orjson and json accept UTF-8 bytes, so skip the separate text decode
+    result = subprocess.run(['bd'] + args + ['--json'], capture_output=True)
+    return json_loads(result.stdout) if result.stdout else []
+
+def close_epic(epic_id, reason, retries=3):
+    """Close an epic, backing off and retrying if the database is locked."""
+    for attempt in range(retries):
+        result = subprocess.run(['bd', 'close', epic_id, '--reason', reason], capture_output=True, text=True, encoding='utf-8', errors='ignore')
+        if result.returncode == 0 or attempt == retries - 1:
+            return result
+        time.sleep(0.1 * 2 ** attempt)
 
 def get_all_epics():
-    """Get all open epic issues."""
-    output = run_bd_command(['list', '--status=open', '--limit', '0'])
-    epics = []
-
-    for line in output.strip().split('\n'):
-        if '[epic]' in line and '[P1]' in line:
-            # Parse line format: beads-tui-xxxx [P1] [epic] open - Title
-            match = re.match(r'(beads-tui-\w+)\s+\[P\d\]\s+\[epic\]\s+\w+\s+-\s+(.+)', line)
-            if match:
-                epic_id = match.group(1)
-                title = match.group(2).strip()
-                epics.append({'id': epic_id, 'title': title})
-
-    return epics
-
-def get_epic_details(epic_id):
-    """Get detailed information about an epic."""
-    output = run_bd_command(['show', epic_id])
-
-    details = {'id': epic_id, 'created': None, 'blocks_count': 0}
-
-    for line in output.split('\n'):
-        if line.startswith('Created:'):
-            created_str = line.replace('Created:', '').strip()
-            try:
-                details['created'] = datetime.strptime(created_str, '%Y-%m-%d %H:%M')
-            except:
-                pass
-        elif line.startswith('Blocks'):
-            match = re.search(r'Blocks \((\d+)\):', line)
-            if match:
-                details['blocks_count'] = int(match.group(1))
-
-    return details
+    """Get all open P1 epic issues, including created_at and blocks."""
+    issues = run_bd_json(['list', '--status=open', '--limit', '0'])
+    return [i for i in issues if i.get('issue_type') == 'epic' and i.get('priority') == 1]
 
 def main():
     print("🔍 Finding all epic duplicates...")
 
-    # Group epics by title
-    epics_by_title = defaultdict(list)
     all_epics = get_all_epics()
 
     print(f"Found {len(all_epics)} total epics")
 
-    for epic in all_epics:
-        epics_by_title[epic['title']].append(epic['id'])
+    # Group epics by title, keeping only titles with more than one epic
+    def epic_title(e):
+        return e['title'].strip()
 
-    # Find duplicates (titles with more than one epic)
-    duplicates = {title: ids for title, ids in epics_by_title.items() if len(ids) > 1}
+    all_epics.sort(key=epic_title)
+    duplicates = {}
+    for title, group in groupby(all_epics, key=epic_title):
+        group = list(group)
+        if len(group) > 1:
+            duplicates[title] = group
 
     if not duplicates:
         print("✅ No duplicates found!")
         return
 
     print(f"\n📋 Found {len(duplicates)} epic categories with duplicates:")
-    for title, ids in duplicates.items():
-        print(f"  {title}: {len(ids)} instances")
+    for title, epics in duplicates.items():
+        print(f"  {title}: {len(epics)} instances")
 
     to_close = []
 
     # For each category, find the newest epic with most dependencies
-    for title, epic_ids in duplicates.items():
+    for title, epics in duplicates.items():
         print(f"\n🔎 Analyzing '{title}'...")
 
-        epic_details = []
-        for epic_id in epic_ids:
-            details = get_epic_details(epic_id)
-            epic_details.append(details)
-            print(f"  {epic_id}: created={details['created']}, blocks={details['blocks_count']}")
+        for e in epics:
+            print(f"  {e['id']}: created={e.get('created_at')}, blocks={len(e.get('blocks') or [])}")
 
-        # Sort by blocks_count (desc) then by created time (desc)
-        epic_details.sort(key=lambda x: (x['blocks_count'], x['created'] or datetime.min), reverse=True)
+        # Sort by blocks count (desc) then by created time (desc); the stable
+        # sort leaves identical snapshots in id order, so the smallest id wins
+        epics.sort(key=lambda e: e['id'])
+        epics.sort(key=lambda e: (len(e.get('blocks') or []), e.get('created_at') or ''), reverse=True)
 
-        keeper = epic_details[0]['id']
-        duplicates_to_close = [e['id'] for e in epic_details[1:]]
+        keeper = epics[0]['id']
+        duplicates_to_close = [e['id'] for e in epics[1:]]
 
         print(f"  ✓ Keeping: {keeper}")
         print(f"  ✗ Closing: {', '.join(duplicates_to_close)}")
@@ -106,9 +91,20 @@ def main():
     # Close all duplicates
     print(f"\n🗑️  Closing {len(to_close)} duplicate epics...")
 
-    for epic_id, reason in to_close:
-        print(f"  Closing {epic_id}...")
-        subprocess.run(['bd', 'close', epic_id, '--reason', reason])
+    # Closes are independent; keep the pool small to limit sqlite lock contention
+    print_lock = threading.Lock()
+
+    def close_one(item):
+        epic_id, reason = item
+        result = close_epic(epic_id, reason)
+        with print_lock:
+            if result.returncode == 0:
+                print(f"  Closed {epic_id}")
+            else:
+                print(f"  ✗ Failed to close {epic_id}: {result.stderr.strip()}")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(close_one, to_close))
 
     print("\n✅ Cleanup complete!")
 